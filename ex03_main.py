@@ -1,10 +1,10 @@
 ## Standard libraries
 import os
 import numpy as np
-import random
 import tqdm
 import pandas as pd
 import argparse
+import types
 from typing import Union, Dict
 
 ## Imports for plotting
@@ -24,9 +24,12 @@ import torchvision
 import pytorch_lightning as pl
 from pytorch_lightning.callbacks import LearningRateMonitor, ModelCheckpoint
 
-# Deterministic operations on GPU
-torch.backends.cudnn.deterministic = True
-torch.backends.cudnn.benchmark = False
+# Fast (non-deterministic) operations on GPU: the conv stack runs on fixed input shapes, so cuDNN benchmark mode can
+# pick the best algorithms once, and TF32 uses the tensor cores on Ampere+. Use --deterministic to opt out.
+torch.backends.cudnn.benchmark = True
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision('high')
 device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
 
 ## Misc
@@ -34,7 +37,7 @@ from sklearn.metrics import roc_auc_score, average_precision_score, precision_re
 
 from ex03_data import get_datasets, TransformTensorDataset
 from ex03_model import ShallowCNN
-from ex03_ood import score_fn
+from ex03_ood import score_loader
 
 
 def parse_args():
@@ -61,13 +64,105 @@ def parse_args():
                         help='number of output nodes/classes (default: 1 (EBM), 42 (JEM))')
     parser.add_argument('--ccond_sample', type=bool, default=False,
                         help='flag that specifies class-conditional or unconditional sampling (default: false')
-    parser.add_argument('--num_workers', type=int, default="0",
-                        help='number of loading workers, needs to be 0 for Windows')
+    parser.add_argument('--num_workers', type=int, default=None,
+                        help='number of loading workers (default: half the CPU cores, at least 2), '
+                             'needs to be 0 for Windows')
+    parser.add_argument('--deterministic', action='store_true',
+                        help='use deterministic GPU operations instead of cuDNN benchmark mode and TF32')
+    parser.add_argument('--no_bf16', action='store_true',
+                        help='train and sample in FP32 instead of bf16 mixed precision (bf16 is only used if the GPU '
+                             'supports it)')
+    parser.add_argument('--no_compile', action='store_true',
+                        help='run the CNN, the SGLD steps and the optimizer eagerly instead of compiling them with '
+                             'torch.compile (e.g. on Windows, where Inductor/Triton support is limited)')
     return parser.parse_args()
 
 
+def loader_kwargs(num_workers=None, persistent=True):
+    """
+    DataLoader settings that overlap batch preparation with the GPU work: pinned memory, and (for loaders that are
+    iterated repeatedly, e.g. train/val) persistent workers with prefetching (only valid for num_workers > 0).
+
+    :param num_workers: number of loading workers, None to use half the CPU cores (at least 2)
+    :param persistent: keep the workers alive across epochs and prefetch more batches; not useful for one-shot loaders
+    :return: keyword arguments for data.DataLoader
+    """
+    if num_workers is None:
+        num_workers = max(2, (os.cpu_count() or 2) // 2)
+    kwargs = {'num_workers': num_workers, 'pin_memory': True}
+    if persistent and num_workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=4)
+    return kwargs
+
+
+def bf16_supported():
+    """
+    Check whether bf16 mixed precision can be used on the current device (CUDA GPUs with bf16 support, e.g. Ampere+).
+
+    :return: True if bf16 autocast is supported
+    """
+    return device.type == 'cuda' and torch.cuda.is_bf16_supported()
+
+
+def set_deterministic():
+    """
+    Switch to deterministic operations on GPU (disables cuDNN benchmark mode and TF32).
+    """
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cuda.matmul.allow_tf32 = False
+    torch.backends.cudnn.allow_tf32 = False
+    torch.set_float32_matmul_precision('highest')
+
+
+def _brownian_noise(inp_imgs):
+    """
+    Brownian noise step: adds small Gaussian noise and projects back to [-1, 1] (when compiled, the noise is generated
+    inside the fused kernel, so no noise tensor is materialized).
+
+    :param inp_imgs: Current samples (updated in-place)
+    """
+    inp_imgs.add_(torch.randn_like(inp_imgs), alpha=0.005)
+    inp_imgs.clamp_(-1, 1)
+
+
+def _sgld_update(inp_imgs, grad, step_size):
+    """
+    SGLD update: clips the gradients, takes a step against the energy gradient and projects back to [-1, 1]. (Fused
+    into a single kernel when compiled.)
+
+    :param inp_imgs: Current samples (updated in-place)
+    :param grad: Gradient of the energy w.r.t. the samples
+    :param step_size: Learning rate/update step size
+    """
+    inp_imgs.add_(grad.clamp(-0.03, 0.03), alpha=-step_size)  # for stability reasons, we clip the gradients
+    inp_imgs.clamp_(-1, 1)
+
+
+def _compile_optimizer_step(optimizer):
+    """
+    Replace the step of a torch.optim optimizer by a compiled version that fuses the per-parameter updates. Lightning
+    still drives the step (hooks, gradient clipping and bookkeeping happen in the closure it passes); only the closure
+    is run eagerly, since it contains the whole training step.
+
+    :param optimizer: torch.optim optimizer (patched in-place)
+    """
+    compiled_step = torch.compile(optimizer.step, fullgraph=False)
+
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        compiled_step()
+        return loss
+
+    # bound as a method, since LR schedulers wrap optimizer.step via its __func__/__self__
+    optimizer.step = types.MethodType(step, optimizer)
+
+
 class MCMCSampler:
-    def __init__(self, model, img_shape, sample_size, num_classes, cbuffer_size=256):
+    def __init__(self, model, img_shape, sample_size, num_classes, cbuffer_size=256, compile_steps=True, bf16=True):
         """
         MCMC sampler that uses SGLD.
 
@@ -76,9 +171,18 @@ class MCMCSampler:
         :param sample_size: Number of images to sample
         :param num_classes: Number of output nodes, i.e., number of classes
         :param cbuffer_size: Size of the buffer per class the is being retained for reservoir sampling
+        :param compile_steps: Compile the elementwise SGLD steps (otherwise they run eagerly)
+        :param bf16: Evaluate the energy in bf16 mixed precision (only if supported by the device)
         """
         super().__init__()
         self.model = model
+        self.bf16 = bf16 and bf16_supported()
+        if compile_steps:
+            self._brownian_noise = torch.compile(_brownian_noise, dynamic=False)
+            self._sgld_update = torch.compile(_sgld_update, dynamic=False)
+        else:
+            self._brownian_noise = _brownian_noise
+            self._sgld_update = _sgld_update
         self.img_shape = img_shape
         self.sample_size = sample_size
         self.num_classes = num_classes
@@ -87,16 +191,19 @@ class MCMCSampler:
         self.max_len = 1024
         self.soft = torch.nn.Softmax(dim=1)
 
-        # Buffers for cond/uncond sampling
-        self.buffers_uncond = [(torch.rand((1,) + self.img_shape) * 2 - 1) for _ in range(self.cbuffer_size)]
-        self.buffers_cond = {i: [(torch.rand((1,) + self.img_shape) * 2 - 1) for _ in range(self.cbuffer_size)] for i in range(self.num_classes)}
+        # Buffers for cond/uncond sampling: preallocated on the GPU and used as ring buffers. The write heads point to
+        # the oldest entry, which is the next one to be replaced.
+        self.buffer_uncond = torch.rand((self.max_len,) + self.img_shape, device=device) * 2 - 1
+        self.buffer_cond = torch.rand((self.num_classes, self.cbuffer_size) + self.img_shape, device=device) * 2 - 1
+        self.head_uncond = torch.zeros((), dtype=torch.long, device=device)
+        self.heads_cond = torch.zeros(self.num_classes, dtype=torch.long, device=device)
 
     def synthesize_samples(self, clabel=None, steps=60, step_size=10, return_img_per_step=False):
         """
         Synthesize images from the current parameterized q_\theta
 
         :param model: Neural network to use to model E_theta
-        :param clabel: Class label(s) used to sample the buffer
+        :param clabel: Per-sample class labels (tensor of size sample_size) used to sample the buffer
         :param steps: Number of iterations in the MCMC algorithm.
         :param step_size: Learning rate/update step size
         :param return_img_per_step: images during MCMC-based synthesis
@@ -126,57 +233,55 @@ class MCMCSampler:
         # (consider saving that into a field of this class). In this buffer, you store the synthesized samples after
         # each SGLD procedure. In the class-conditional setting, you want to have individual buffers per class.
         # Please make sure that you keep the buffer finite to not run into memory-related problems.
-        num_imgs_gaussian = 0
-        for _ in range(100): # 20% of the images are sampled from Gaussian noise
-            num_imgs_gaussian = np.random.binomial(self.sample_size, 0.2)
-            if num_imgs_gaussian != 0:
-                break
+        num_imgs_gaussian = max(1, int(round(self.sample_size * 0.2)))  # 20% of the images are sampled from Gaussian noise
         num_imgs_reservoir = self.sample_size - num_imgs_gaussian  # the rest is sampled from the buffer
         # gaussian_img = torch.randn((num_imgs_gaussian,) + self.img_shape) * 2 - 1
         # reservoir_img = torch.cat(random.choices(self.buffers, k=num_imgs_reservoir), dim=0)
 
+        gaussian_img = torch.randn((num_imgs_gaussian,) + self.img_shape, device=device) * 2 - 1
         if clabel is not None:
-            gaussian_img = torch.randn((num_imgs_gaussian,) + self.img_shape) * 2 - 1
-            reservoir_img = torch.cat(random.choices(self.buffers_cond[clabel[0].item()], k=num_imgs_reservoir), dim=0)
+            # each image is taken from the buffer of its own class label (one gather over all class buffers)
+            clabel = clabel.to(device)
+            buffer_idx = torch.randint(0, self.cbuffer_size, (num_imgs_reservoir,), device=device)
+            reservoir_img = self.buffer_cond[clabel[num_imgs_gaussian:], buffer_idx]
         else:
-            gaussian_img = torch.randn((num_imgs_gaussian,) + self.img_shape) * 2 - 1
-            reservoir_img = torch.cat(random.choices(self.buffers_uncond, k=num_imgs_reservoir), dim=0)
+            buffer_idx = torch.randint(0, self.max_len, (num_imgs_reservoir,), device=device)
+            reservoir_img = self.buffer_uncond[buffer_idx]
 
-        inp_imgs = torch.cat([gaussian_img, reservoir_img], dim=0).detach().to(torch.device('cuda:0'))  # corresponds to the initial sample(s) x^0
+        inp_imgs = torch.cat([gaussian_img, reservoir_img], dim=0).detach()  # corresponds to the initial sample(s) x^0
+        inp_imgs = inp_imgs.contiguous(memory_format=torch.channels_last)
         inp_imgs.requires_grad = True
 
-        # List for storing generations at each step
-        imgs_per_step = []
+        # Preallocated storage for the generations at each step
+        imgs_per_step = torch.empty((steps,) + inp_imgs.shape, device=inp_imgs.device) if return_img_per_step else None
 
-        noise = torch.randn(inp_imgs.shape, device = inp_imgs.device) # Brownian noise
+        samples = inp_imgs.detach()  # shares the storage of inp_imgs, used for the in-place (non-autograd) updates
 
         # Execute K MCMC steps
-        for _ in range(steps):
+        for k in range(steps):
             # (1) Add small noise to the input 'inp_imgs' (which are normalized to a range of -1 to 1).
             # This corresponds to the Brownian noise that allows to explore the entire parameter space.
-            noise.normal_(0, 0.005)
-            inp_imgs.data.add_(noise.data)
-            inp_imgs.data.clamp_(-1, 1)
-            
+            self._brownian_noise(samples)
+
             # (2) Calculate gradient-based score function at the current step. In case of the JEM implementation AND
             # class-conditional sampling (which is optional from a methodological point of view), make sure that you
             # plug in some label information as well as we want to calculate E(x,y) and not only E(x).
 
-            out_imgs = -self.model(inp_imgs)
+            # The energy is evaluated in bf16 (if enabled), while the samples and the SGLD update below stay in FP32
+            # for stability
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=self.bf16):
+                out_imgs = -self.model(inp_imgs)
             out_imgs.sum().backward()
-            inp_imgs.grad.data.clamp_(-0.03, 0.03)  # for stability reasons, we clip the gradients to a small range
 
             # (3) Perform gradient ascent to regions of higher probability
             # (gradient descent if we consider the energy surface!). You can use the parameter 'step_size' which can be
             # considered the learning rate of the SGLD update.
-            inp_imgs.data.add_(-step_size * inp_imgs.grad.data)
-            inp_imgs.grad.detach_()
-            inp_imgs.grad.zero_()
-            inp_imgs.data.clamp_(-1, 1)
+            self._sgld_update(samples, inp_imgs.grad, step_size)
+            inp_imgs.grad = None
 
             # (4) Optional: save (detached) intermediate images in the imgs_per_step variable
             if return_img_per_step:
-                imgs_per_step.append(inp_imgs.clone().detach())
+                imgs_per_step[k].copy_(samples)
 
         # reactivate the gradients for parameters for training
         for p in self.model.parameters():
@@ -186,25 +291,30 @@ class MCMCSampler:
         torch.set_grad_enabled(had_gradients_enabled)
 
         if return_img_per_step:
-            return torch.stack(imgs_per_step, dim=0)
+            return imgs_per_step
 
-        # Add the synthesized images to the buffer and remove the old ones -> inplace update
-        list_input_imgs = list(inp_imgs.to(torch.device('cpu')).chunk(self.sample_size, dim=0))
+        # Add the synthesized images to the buffer by overwriting the oldest ones -> inplace update
+        synth_imgs = inp_imgs.detach()
         if clabel is not None:
-            for i, label in enumerate(clabel):
-                cls = label.item()
-                self.buffers_cond[cls] = [list_input_imgs[i]] + self.buffers_cond[cls]
-                self.buffers_cond[cls] = self.buffers_cond[cls][:self.cbuffer_size]
+            # images sharing a label are written to consecutive slots after the head of their class buffer
+            onehot = torch.nn.functional.one_hot(clabel, self.num_classes)
+            rank = (onehot.cumsum(dim=0) - 1).gather(1, clabel.unsqueeze(1)).squeeze(1)
+            slots = (self.heads_cond[clabel] + rank) % self.cbuffer_size
+            self.buffer_cond[clabel, slots] = synth_imgs
+            self.heads_cond = (self.heads_cond + onehot.sum(dim=0)) % self.cbuffer_size
         else:
-            self.buffers_uncond = list_input_imgs + self.buffers_uncond
-            self.buffers_uncond = self.buffers_uncond[:self.max_len]
+            num_imgs = synth_imgs.shape[0]
+            slots = (self.head_uncond + torch.arange(num_imgs, device=device)) % self.max_len
+            self.buffer_uncond[slots] = synth_imgs
+            self.head_uncond = (self.head_uncond + num_imgs) % self.max_len
 
         return inp_imgs
 
 
 class JEM(pl.LightningModule):
     def __init__(self, img_shape, batch_size, num_classes=42, cbuffer_size=256, ccond_sample=False, alpha=0.1, lmbd=0.1,
-                 lr=1e-4, lr_stepsize=1, lr_gamma=0.97, m_in=0, m_out=-10, steps=60, step_size_decay=1.0, **MODEL_args):
+                 lr=1e-4, lr_stepsize=1, lr_gamma=0.97, m_in=0, m_out=-10, steps=60, step_size_decay=1.0,
+                 compile_model=True, enable_full_metrics=False, bf16=True, **MODEL_args):
         super().__init__()
         self.save_hyperparameters()
 
@@ -212,14 +322,22 @@ class JEM(pl.LightningModule):
         self.batch_size = batch_size
         self.num_classes = num_classes
         self.ccond_sample = ccond_sample
-        self.cnn = ShallowCNN(**MODEL_args)
+        # NHWC (channels_last) layout for the conv stack, matching the fastest tensor-core conv kernels
+        self.cnn = ShallowCNN(**MODEL_args).to(memory_format=torch.channels_last)
+        if compile_model:
+            # The SGLD loop calls the CNN (forward + backward) many times on fixed-shape inputs, so we capture it as a
+            # compiled graph (CUDA graphs via "reduce-overhead"). Module.compile() compiles in-place, so the state dict
+            # keys (and therefore existing checkpoints) stay unchanged, and the sampler below uses the compiled CNN too.
+            # No fullgraph=True: calls under a torch dispatch mode (e.g. Lightning's model summary, which runs the
+            # example_input_array under a FLOP counter) cannot be compiled and must fall back to eager.
+            self.cnn.compile(mode="reduce-overhead", dynamic=False)
 
         # During training, we want to use the MCMC-based sampler to synthesize images from the current q_\theta and
         # use these in the contrastive loss functional to update the model parameters \theta.
         # (Intuitively, we alternate between sampling from q_\theta and updating q_\theta, which is a quite challenging
         # minmax setting with an adversarial interpretation.)
         self.sampler = MCMCSampler(self.cnn, img_shape=img_shape, sample_size=batch_size, num_classes=num_classes,
-                                   cbuffer_size=cbuffer_size)
+                                   cbuffer_size=cbuffer_size, compile_steps=compile_model, bf16=bf16)
         self.example_input_array = torch.zeros(1, *img_shape)  # this is used to validate data and model compatability
 
         # If you want, you can use Torchmetrics to evaluate your classification performance!
@@ -230,24 +348,34 @@ class JEM(pl.LightningModule):
         # end of each epoch.
         #         self.log_dict(self.train_metrics, on_step=False, on_epoch=True)
         # Please refer to the torchmetrics documentation if this process is not clear.
-        metrics = torchmetrics.MetricCollection([torchmetrics.CohenKappa(num_classes=num_classes,task='multiclass'),
-                                                 torchmetrics.AveragePrecision(num_classes=num_classes,task='multiclass'),
-                                                 torchmetrics.AUROC(num_classes=num_classes,task='multiclass'),
-                                                 torchmetrics.MatthewsCorrCoef(num_classes=num_classes,task='multiclass'),
-                                                 torchmetrics.CalibrationError(task='multiclass',num_classes=num_classes)])
-        dyna_metrics = [torchmetrics.Accuracy,
-                        torchmetrics.Precision,
-                        torchmetrics.Recall,
-                        torchmetrics.Specificity,
-                        torchmetrics.F1Score]
-
-        self.train_metrics = metrics.clone(prefix='train_')
-        self.valid_metrics = metrics.clone(prefix='val_')
-        for mode in ['micro', 'macro']:
-            self.train_metrics.add_metrics(
-                {f"{mode}_{m.__name__}": m(average=mode, num_classes=num_classes,task='multiclass') for m in dyna_metrics})
-            self.valid_metrics.add_metrics(
-                {f"{mode}_{m.__name__}": m(average=mode, num_classes=num_classes,task='multiclass') for m in dyna_metrics})
+        # The full set of metrics is only constructed if requested (enable_full_metrics=True), since every metric keeps
+        # its own state buffers (and e.g. the calibration error grows with every update). By default, only the
+        # lightweight micro accuracy and average precision are tracked (under the same names as in the full set).
+        if enable_full_metrics:
+            metrics = torchmetrics.MetricCollection([torchmetrics.CohenKappa(num_classes=num_classes,task='multiclass'),
+                                                     torchmetrics.AveragePrecision(num_classes=num_classes,task='multiclass'),
+                                                     torchmetrics.AUROC(num_classes=num_classes,task='multiclass'),
+                                                     torchmetrics.MatthewsCorrCoef(num_classes=num_classes,task='multiclass'),
+                                                     torchmetrics.CalibrationError(task='multiclass',num_classes=num_classes)])
+            dyna_metrics = [torchmetrics.Accuracy,
+                            torchmetrics.Precision,
+                            torchmetrics.Recall,
+                            torchmetrics.Specificity,
+                            torchmetrics.F1Score]
+
+            self.train_metrics = metrics.clone(prefix='train_')
+            self.valid_metrics = metrics.clone(prefix='val_')
+            for mode in ['micro', 'macro']:
+                self.train_metrics.add_metrics(
+                    {f"{mode}_{m.__name__}": m(average=mode, num_classes=num_classes,task='multiclass') for m in dyna_metrics})
+                self.valid_metrics.add_metrics(
+                    {f"{mode}_{m.__name__}": m(average=mode, num_classes=num_classes,task='multiclass') for m in dyna_metrics})
+        else:
+            metrics = torchmetrics.MetricCollection({
+                'micro_Accuracy': torchmetrics.Accuracy(average='micro', num_classes=num_classes, task='multiclass'),
+                'MulticlassAveragePrecision': torchmetrics.AveragePrecision(num_classes=num_classes, task='multiclass')})
+            self.train_metrics = metrics.clone(prefix='train_')
+            self.valid_metrics = metrics.clone(prefix='val_')
 
         self.hp_metric = torchmetrics.AveragePrecision(num_classes=num_classes,task='multiclass')
 
@@ -259,13 +387,23 @@ class JEM(pl.LightningModule):
         # We typically do not want to have momentum enabled. This is because when training the EBM using alternating
         # steps of synthesis and model update, we constantly shift the energy surface, making it hard to make momentum
         # helpful.
-        optimizer = optim.Adam(self.parameters(), lr=self.hparams.lr, betas=(0.0, 0.999))
+        # With a compiled optimizer step, the learning rate is passed as a tensor so that the StepLR updates do not
+        # trigger a recompilation of the step every time the learning rate changes.
+        lr = torch.tensor(self.hparams.lr) if self.hparams.compile_model else self.hparams.lr
+        optimizer = optim.Adam(self.parameters(), lr=lr, betas=(0.0, 0.999))
+        if self.hparams.compile_model:
+            # patched before creating the scheduler, which wraps optimizer.step to track its calls
+            _compile_optimizer_step(optimizer)
 
         # Exponential decay over epochs
         scheduler = optim.lr_scheduler.StepLR(optimizer, self.hparams.lr_stepsize,
                                               gamma=self.hparams.lr_gamma)
         return [optimizer], [scheduler]
 
+    def optimizer_zero_grad(self, epoch, batch_idx, optimizer):
+        # Reset the gradients to None instead of writing zeros into every parameter gradient
+        optimizer.zero_grad(set_to_none=True)
+
     def px_step(self, batch, ccond_sample=True):
         # TODO (3.4): Implement p(x) step.
         # In addition to calculating the contrastive loss, also consider using an L2 regularization loss. This allows us
@@ -276,13 +414,14 @@ class JEM(pl.LightningModule):
         #         cdiv_loss = ...
         #         loss = reg_loss + cdiv_loss
         real_imgs, real_labs = batch
+        real_imgs = real_imgs.contiguous(memory_format=torch.channels_last)
         # real_imgs = real_imgs.to(self.device)
         small_noise = torch.randn_like(real_imgs) * 0.005
         real_imgs.add_(small_noise).clamp_(-1, 1)
 
         if ccond_sample:
             real_out = self.cnn(real_imgs, real_labs)
-            fake_labs = torch.randint(0, self.num_classes, (self.batch_size,))
+            fake_labs = torch.randint(0, self.num_classes, (self.batch_size,), device=self.device)
             fake_imgs = self.sampler.synthesize_samples(clabel=fake_labs)
             fake_out = self.cnn(fake_imgs, fake_labs)
         else:
@@ -302,7 +441,8 @@ class JEM(pl.LightningModule):
         # TODO (3.4): Implement p(y|x) step.
         # Here, we want to calculate the classification loss using the class logits infered by the neural network.
         real_imgs, real_labels = batch
-        logits = self.cnn(real_imgs, real_labels)
+        real_imgs = real_imgs.contiguous(memory_format=torch.channels_last)
+        logits = self.cnn.get_logits(real_imgs)
         loss = torch.nn.CrossEntropyLoss()(logits, real_labels)
         return loss
 
@@ -352,7 +492,7 @@ def run_training(args) -> pl.LightningModule:
     # Hyper-parameters
     ckpt_dir = args.ckpt_dir
     data_dir = args.data_dir
-    num_workers = args.num_workers  # 0 for Windows, can be set higher for linux
+    num_workers = args.num_workers
     batch_size = args.batch_size
     num_epochs = args.num_epochs
     num_classes = args.num_classes
@@ -369,13 +509,15 @@ def run_training(args) -> pl.LightningModule:
     # Datasets & Dataloaders
     datasets: Dict[str, TransformTensorDataset] = get_datasets(data_dir)
     train_loader = data.DataLoader(datasets['train'], batch_size=batch_size, shuffle=True, drop_last=True,
-                                   num_workers=num_workers, pin_memory=True)
+                                   **loader_kwargs(num_workers))
     val_loader = data.DataLoader(datasets['val'], batch_size=batch_size, shuffle=False, drop_last=False,
-                                 num_workers=num_workers)
+                                 **loader_kwargs(num_workers))
 
+    use_bf16 = not args.no_bf16 and bf16_supported()
     trainer = pl.Trainer(default_root_dir=ckpt_dir,
                          #gpus=1 if str(device).startswith("cuda") else 0,
                          max_epochs=num_epochs,
+                         precision='bf16-mixed' if use_bf16 else '32-true',
                          gradient_clip_val=0.1,
                          callbacks=[
                              ModelCheckpoint(save_weights_only=True, mode="min", monitor='val_contrastive_divergence',
@@ -397,10 +539,13 @@ def run_training(args) -> pl.LightningModule:
                 lr_gamma=lr_gamma,  # Multiplicative factor for exponential learning rate decay
                 lr_stepsize=lr_stepsize,  # Step size for exponential learning rate decay
                 alpha=alpha,  # L2 regularization of energy terms
-                step_size_decay=1.0  # Multiplicative factor for SGLD step size decay)
+                step_size_decay=1.0,  # Multiplicative factor for SGLD step size decay)
+                compile_model=not args.no_compile,  # Compile the CNN, SGLD steps and optimizer step
+                bf16=use_bf16  # bf16 mixed precision for the SGLD energy evaluations
                 )
     trainer.fit(model, train_loader, val_loader)
-    model = JEM.load_from_checkpoint(trainer.checkpoint_callback.best_model_path)
+    model = JEM.load_from_checkpoint(trainer.checkpoint_callback.best_model_path,
+                                     compile_model=not args.no_compile, bf16=not args.no_bf16)
     return model
 
 
@@ -413,14 +558,13 @@ def run_generation(args, ckpt_path: Union[str, Path], conditional: bool = False)
     :param conditional: flag to specify if we want to generate conditioned on a specific class label or not
     :return: None
     """
-    model = JEM.load_from_checkpoint(ckpt_path)
+    model = JEM.load_from_checkpoint(ckpt_path, compile_model=not args.no_compile, bf16=not args.no_bf16)
     model.to(device)
     pl.seed_everything(25)
 
-    def gen_imgs(model, clabel=None, step_size=10, batch_size=24, num_steps=256):
+    def gen_imgs(model, mcmc_sampler, clabel=None, step_size=10, num_steps=256):
         model.eval()
         torch.set_grad_enabled(True)  # Tracking gradients for sampling necessary
-        mcmc_sampler = MCMCSampler(model, model.img_shape, batch_size, model.num_classes)
         img = mcmc_sampler.synthesize_samples(clabel, steps=num_steps, step_size=step_size, return_img_per_step=True)
         torch.set_grad_enabled(False)
         model.train()
@@ -432,16 +576,21 @@ def run_generation(args, ckpt_path: Union[str, Path], conditional: bool = False)
     # [1:42]
     conditional_labels = range(0, 42)
 
+    # One sampler (and thus one set of buffers) is shared across all labels
+    mcmc_sampler = MCMCSampler(model, model.img_shape, bs, model.num_classes,
+                               compile_steps=model.hparams.compile_model, bf16=model.hparams.bf16)
+
     synth_imgs = []
     for label in tqdm.tqdm(conditional_labels):
         clabel = (torch.ones(bs) * label).type(torch.LongTensor).to(model.device)
-        generated_imgs = gen_imgs(model, clabel=clabel if conditional else None, step_size=10, batch_size=bs, num_steps=num_steps).cpu()
+        generated_imgs = gen_imgs(model, mcmc_sampler, clabel=clabel if conditional else None, step_size=10,
+                                  num_steps=num_steps)
 
         # Visualize sampling process
         i = 0
         step_size = num_steps // 8
         imgs_to_plot = generated_imgs[step_size - 1::step_size, i]
-        imgs_to_plot = torch.cat([generated_imgs[0:1, i], imgs_to_plot], dim=0)
+        imgs_to_plot = torch.cat([generated_imgs[0:1, i], imgs_to_plot], dim=0).cpu()  # only copy the plotted steps
         synth_imgs.append(imgs_to_plot[-1])
         grid = torchvision.utils.make_grid(imgs_to_plot, nrow=imgs_to_plot.shape[0], normalize=True,
                                            value_range=(-1, 1), pad_value=0.5, padding=2)
@@ -477,7 +626,7 @@ def run_evaluation(args, ckpt_path: Union[str, Path]):
     :param ckpt_path: local path to the trained checkpoint.
     :return: None
     """
-    model = JEM.load_from_checkpoint(ckpt_path)
+    model = JEM.load_from_checkpoint(ckpt_path, compile_model=not args.no_compile, bf16=not args.no_bf16)
     model.to(device)
     pl.seed_everything(42)
 
@@ -489,7 +638,7 @@ def run_evaluation(args, ckpt_path: Union[str, Path]):
 
     # Test loader
     test_loader = data.DataLoader(datasets['test'], batch_size=batch_size, shuffle=False, drop_last=False,
-                                  num_workers=num_workers)
+                                  **loader_kwargs(num_workers, persistent=False))
 
     trainer = pl.Trainer() #gpus=1 if str(device).startswith("cuda") else 0)
     results = trainer.validate(model, dataloaders=test_loader)
@@ -506,7 +655,7 @@ def run_ood_analysis(args, ckpt_path: Union[str, Path]):
     :param ckpt_path: local path to the trained checkpoint.
     :return: None
     """
-    model = JEM.load_from_checkpoint(ckpt_path)
+    model = JEM.load_from_checkpoint(ckpt_path, compile_model=not args.no_compile, bf16=not args.no_bf16)
     model.to(device)
     pl.seed_everything(42)
 
@@ -518,23 +667,20 @@ def run_ood_analysis(args, ckpt_path: Union[str, Path]):
 
     # Test loader
     test_loader = data.DataLoader(datasets['test'], batch_size=batch_size, shuffle=False, drop_last=False,
-                                  num_workers=num_workers)
+                                  **loader_kwargs(num_workers, persistent=False))
     # OOD loaders for OOD types a and b
     ood_ta_loader = data.DataLoader(datasets['ood_ta'], batch_size=batch_size, shuffle=False, drop_last=False,
-                                    num_workers=num_workers)
+                                    **loader_kwargs(num_workers, persistent=False))
     ood_tb_loader = data.DataLoader(datasets['ood_tb'], batch_size=batch_size, shuffle=False, drop_last=False,
-                                    num_workers=num_workers)
+                                    **loader_kwargs(num_workers, persistent=False))
 
     # TODO (3.6): Calculate and visualize the score distributions, e.g. with a histogram. Analyze whether we can
     #  visualy tell apart the different data distributions based on their assigned score.
-    # move the tensor out of the DataLoader
-    test_loader_tensor = torch.cat([x[0] for x in test_loader], dim=0)
-    ood_ta_loader_tensor = torch.cat([x[0] for x in ood_ta_loader], dim=0)
-    ood_tb_loader_tensor = torch.cat([x[0] for x in ood_tb_loader], dim=0)
-
-    scores_test_loader = score_fn(model, test_loader_tensor.to(model.device), score="px")
-    scores_ood_ta_loader = score_fn(model, ood_ta_loader_tensor.to(model.device), score="px")
-    scores_ood_tb_loader = score_fn(model, ood_tb_loader_tensor.to(model.device), score="px")
+    # The p(x) scores are a pure inference pass, so no autograd bookkeeping is needed
+    with torch.inference_mode():
+        scores_test_loader = score_loader(model, test_loader, score="px")
+        scores_ood_ta_loader = score_loader(model, ood_ta_loader, score="px")
+        scores_ood_tb_loader = score_loader(model, ood_tb_loader, score="px")
     # histogram visualisation of the scores
     plt.hist(scores_test_loader, bins=100, alpha=0.5, label='test')
     plt.hist(scores_ood_ta_loader, bins=100, alpha=0.5, label='ood_ta')
@@ -561,6 +707,8 @@ def run_ood_analysis(args, ckpt_path: Union[str, Path]):
 
 if __name__ == '__main__':
     args = parse_args()
+    if args.deterministic:
+        set_deterministic()
 
     # 1) Run training
     # run_training(args)
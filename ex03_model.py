@@ -2,11 +2,6 @@ import torch
 import torch.nn as nn
 
 
-class Swish(nn.Module):
-    def forward(self, x):
-        return x * torch.sigmoid(x)
-
-
 class ShallowCNN(nn.Module):
     def __init__(self, hidden_features=32, num_classes=42, **kwargs):
         super().__init__()
@@ -14,17 +9,19 @@ class ShallowCNN(nn.Module):
         c_hid2 = hidden_features * 2
         c_hid3 = hidden_features * 4
 
+        # Swish activations via the built-in nn.SiLU (x * sigmoid(x) as a single fused kernel for forward/backward,
+        # which TorchInductor can also fuse into the epilogue of the preceding convolution)
         self.cnn_layers = nn.Sequential(
             nn.Conv2d(1, c_hid1, kernel_size=5, stride=2, padding=4),
-            Swish(),
+            nn.SiLU(),
             nn.Conv2d(c_hid1, c_hid2, kernel_size=3, stride=2, padding=1),
-            Swish(),
+            nn.SiLU(),
             nn.Conv2d(c_hid2, c_hid3, kernel_size=3, stride=2, padding=1),
-            Swish(),
+            nn.SiLU(),
             nn.Conv2d(c_hid3, c_hid3, kernel_size=3, stride=2, padding=1),
-            Swish(),
+            nn.SiLU(),
             nn.Conv2d(c_hid3, c_hid3, kernel_size=3, stride=2, padding=1),
-            Swish(),
+            nn.SiLU(),
         )
         self.fc_layers = nn.Sequential(
             nn.Flatten(),
@@ -34,7 +31,7 @@ class ShallowCNN(nn.Module):
     def get_logits(self, x):
         # TODO (3.2): Implement classification procedure that outputs the logits across the classes
         x = self.cnn_layers(x)
-        x = nn.AdaptiveAvgPool2d((1, 1))(x)
+        x = x.mean(dim=(2, 3))  # global average pooling, already flattened to (B, C)
         x = self.fc_layers(x)
         return x
 
@@ -46,6 +43,6 @@ class ShallowCNN(nn.Module):
             # EBM or unconditional JEM: LOG-SUM-EXP
             return torch.logsumexp(self.get_logits(x), dim=1)
         else:
-            # Conditional JEM
-            y_logits = torch.gather(self.get_logits(x), 1, y.unsqueeze(1))
-            return torch.exp(y_logits)
+            # Conditional JEM: the logit of the given class (used directly as negative energy, no exp)
+            logits = self.get_logits(x)
+            return logits[torch.arange(logits.shape[0], device=logits.device), y]
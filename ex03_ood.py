@@ -19,4 +19,12 @@ def score_fn(model: pl.LightningModule, x: torch.Tensor, y: torch.Tensor = None,
     elif score == "mass":
         return -grad_norm(x, y).detach().cpu()
     else:
-        raise ValueError("Provided score function is not valid.")
\ No newline at end of file
+        raise ValueError("Provided score function is not valid.")
+
+
+def score_loader(model: pl.LightningModule, loader: torch.utils.data.DataLoader, score: str = "px"):
+    # Stream the loader batch-wise through score_fn so that only one batch lives on the GPU at a time
+    scores = []
+    for x, _ in loader:
+        scores.append(score_fn(model, x.to(model.device, non_blocking=True), score=score))
+    return torch.cat(scores)